@@ -1,19 +1,17 @@
 from __future__ import print_function
 
-import enum
 import hashlib
-import httplib
 import logging
-import math
-import pipes
+import mmap
+import multiprocessing
 import json
 import os
+import re
 import shutil
 import subprocess
 import sys
 import tempfile
 import time
-import types
 
 from buntstrap import chroot
 from buntstrap import util
@@ -21,6 +19,29 @@ from buntstrap import util
 VERSION = '0.1.4'
 
 
+@util.memoize
+def get_apt_pkg():
+  """
+  Return the initialized ``apt_pkg`` module from python-apt, or None if
+  python-apt is not installed or the host apt configuration can't be loaded.
+  python-apt is optional. If it's available we use it in place of some
+  subprocess calls to dpkg. It is imported on first use, because
+  ``apt_pkg.init()`` parses the host apt configuration.
+  """
+  try:
+    import apt_pkg
+  except ImportError:
+    return None
+
+  try:
+    apt_pkg.init()
+  except SystemError:  # apt_pkg.Error derives from SystemError
+    logging.warning('Failed to initialize python-apt, falling back to dpkg',
+                    exc_info=True)
+    return None
+  return apt_pkg
+
+
 def install_apt_key(root_dir, keyring_filename, gpg_key):
   """
   Add a public signing key to the apt keyring named `keyring_filename`.
@@ -79,12 +100,118 @@ def force_symlink(target_path, link_location):
     os.symlink(target_path, link_location)
 
 
+# NOTE(josh): control fields which are read for every package in the size
+# report and during extraction. Any field which may span multiple lines must be
+# listed last.
+DEB_INFO_FIELDS = ('Package', 'Version', 'Installed-Size', 'Description-en')
+
+# NOTE(josh): maps the path of a .deb file to a dictionary of control fields
+# that have already been read for that package.
+_deb_info_cache = {}
+
+# NOTE(josh): `dpkg-deb --show` will only read one archive per invocation, so
+# loop over the archives in a single shell rather than spawning one process
+# from python for each package (and for each field). Each record is preceded
+# by an ASCII record-separator line so that the output can be split even if
+# dpkg-deb fails on some archive. A failed archive shows up as an empty record
+# and is queried (and its error reported) again by get_deb_item(), so the
+# script always exits successfully rather than with the status of the last
+# dpkg-deb.
+PREFETCH_SCRIPT = """
+fmt="$1"
+shift
+for deb in "$@"; do
+  printf '\\036\\n'
+  dpkg-deb --show --showformat="$fmt" "$deb" 2>/dev/null
+done
+exit 0
+"""
+
+
+def prefetch_deb_info(deb_list, chunk_size=500):
+  """
+  Read the control fields listed in ``DEB_INFO_FIELDS`` for every package in
+  ``deb_list`` and store them in the cache consulted by ``get_deb_item``.
+  Packages are queried in groups of ``chunk_size`` to keep the command line
+  well under ``ARG_MAX``.
+  """
+
+  deb_list = [deb_path for deb_path in deb_list
+              if deb_path not in _deb_info_cache]
+  showformat = '\\t'.join('${' + field + '}'
+                          for field in DEB_INFO_FIELDS) + '\\n'
+  for offset in range(0, len(deb_list), chunk_size):
+    chunk = deb_list[offset:offset + chunk_size]
+    prefetch_cmd = ['sh', '-c', PREFETCH_SCRIPT, 'sh', showformat] + chunk
+    try:
+      output = util.wrap_subprocess(subprocess.check_output, prefetch_cmd,
+                                    env={'LC_ALL': 'C'})
+    except (OSError, subprocess.CalledProcessError):
+      logging.warn('Failed to prefetch package info, will query packages '
+                   'individually')
+      continue
+
+    records = output.split('\x1e\n')[1:]
+    if len(records) != len(chunk):
+      logging.warn('Failed to parse prefetched package info, will query '
+                   'packages individually')
+      continue
+
+    for deb_path, record in zip(chunk, records):
+      # NOTE(josh): empty record means dpkg-deb failed to read this archive,
+      # in which case we let get_deb_item() query it directly and report the
+      # error.
+      if not record:
+        continue
+      values = record.rstrip('\n').split('\t', len(DEB_INFO_FIELDS) - 1)
+      if len(values) != len(DEB_INFO_FIELDS):
+        continue
+      _deb_info_cache[deb_path] = {
+          field: value.strip()
+          for field, value in zip(DEB_INFO_FIELDS, values)}
+
+
+def get_deb_fields(deb_path, *fields):
+  """
+  Return a tuple of control fields for a package. Control field keys are the
+  positional arguments. Any fields which aren't already in the cache are read
+  with a single call to ``dpkg-deb --field``. For example:
+
+  get_deb_fields(deb_path, 'Package', 'Version')
+  """
+
+  cached = _deb_info_cache.setdefault(deb_path, {})
+  missing = [field for field in fields if field not in cached]
+  if missing:
+    dpkg_cmd = ['dpkg-deb', '--field', deb_path] + missing
+    output = util.wrap_subprocess(subprocess.check_output,
+                                  dpkg_cmd, env={'LC_ALL': 'C'})
+
+    # NOTE(josh): if only one field is requested dpkg-deb prints just the
+    # value, otherwise it prints an rfc822 stanza of the fields which are
+    # present in the package. Field names are case insensitive.
+    if len(missing) == 1:
+      values = {missing[0].lower(): output}
+    else:
+      values = {}
+      key = None
+      for line in output.splitlines():
+        if key is not None and line[:1] in (' ', '\t'):
+          values[key] += '\n' + line
+        else:
+          key, _, value = line.partition(':')
+          key = key.lower()
+          values[key] = value
+
+    for field in missing:
+      cached[field] = values.get(field.lower(), '').strip()
+
+  return tuple(cached[field] for field in fields)
+
+
 def get_deb_item(deb_path, field):
   """Return the value of a control field for a package"""
-
-  dpkg_cmd = ['dpkg', '--field', deb_path, field]
-  return util.wrap_subprocess(subprocess.check_output,
-                              dpkg_cmd, env={'LC_ALL': 'C'}).strip()
+  return get_deb_fields(deb_path, field)[0]
 
 
 def get_deb_info(deb_path, *args):
@@ -94,63 +221,253 @@ def get_deb_info(deb_path, *args):
 
   get_deb_info('Version', 'Package', 'Source', 'Multi-Arch')
   """
-  return (get_deb_item(deb_path, arg) for arg in args)
+  return get_deb_fields(deb_path, *args)
+
+
+def _version_char_order(char):
+  """
+  Return the sort weight of a non-digit character in a debian version string.
+  Tilde sorts before anything, even the end of the string, and letters sort
+  before any other punctuation.
+  """
+  if char == '~':
+    return -1
+  if char.isalpha():
+    return ord(char)
+  return ord(char) + 256
+
+
+def _version_part_cmp(part_a, part_b):
+  """
+  Compare the upstream-version or debian-revision parts of two debian version
+  strings. Port of ``verrevcmp()`` from dpkg's lib/dpkg/version.c.
+  """
+  idx_a = idx_b = 0
+  len_a = len(part_a)
+  len_b = len(part_b)
+  while idx_a < len_a or idx_b < len_b:
+    # NOTE(josh): compare the non-digit prefix character by character
+    while ((idx_a < len_a and not part_a[idx_a].isdigit())
+           or (idx_b < len_b and not part_b[idx_b].isdigit())):
+      order_a = 0
+      if idx_a < len_a and not part_a[idx_a].isdigit():
+        order_a = _version_char_order(part_a[idx_a])
+      order_b = 0
+      if idx_b < len_b and not part_b[idx_b].isdigit():
+        order_b = _version_char_order(part_b[idx_b])
+      if order_a != order_b:
+        return order_a - order_b
+      idx_a += 1
+      idx_b += 1
+
+    # NOTE(josh): then compare the numeric part by value
+    while idx_a < len_a and part_a[idx_a] == '0':
+      idx_a += 1
+    while idx_b < len_b and part_b[idx_b] == '0':
+      idx_b += 1
+    first_diff = 0
+    while (idx_a < len_a and part_a[idx_a].isdigit()
+           and idx_b < len_b and part_b[idx_b].isdigit()):
+      if not first_diff:
+        first_diff = ord(part_a[idx_a]) - ord(part_b[idx_b])
+      idx_a += 1
+      idx_b += 1
+    if idx_a < len_a and part_a[idx_a].isdigit():
+      return 1
+    if idx_b < len_b and part_b[idx_b].isdigit():
+      return -1
+    if first_diff:
+      return first_diff
+
+  return 0
+
+
+def _split_version(version):
+  """
+  Split a debian version string into a tuple of
+  ``(epoch, upstream_version, debian_revision)``.
+  """
+  epoch = 0
+  if ':' in version:
+    epoch, version = version.split(':', 1)
+    epoch = int(epoch)
+  if '-' in version:
+    version, revision = version.rsplit('-', 1)
+  else:
+    revision = ''
+  return epoch, version, revision
+
+
+def dpkg_vercmp(version_a, version_b):
+  """
+  Compare two debian package version strings the same way that
+  ``dpkg --compare-versions`` does. Returns a negative number, zero, or a
+  positive number if ``version_a`` is older than, the same as, or newer than
+  ``version_b`` respectively.
+  """
+  epoch_a, upstream_a, revision_a = _split_version(version_a)
+  epoch_b, upstream_b, revision_b = _split_version(version_b)
+  if epoch_a != epoch_b:
+    return epoch_a - epoch_b
+  result = _version_part_cmp(upstream_a, upstream_b)
+  if result:
+    return result
+  return _version_part_cmp(revision_a, revision_b)
+
+
+def version_is_newer(version, other_version):
+  """
+  Return true if the debian package version string ``version`` is strictly
+  newer than ``other_version``.
+  """
+  apt_pkg = get_apt_pkg()
+  if apt_pkg is not None:
+    return apt_pkg.version_compare(version, other_version) > 0
+  return dpkg_vercmp(version, other_version) > 0
 
 
 def md5sum_file(filepath):
   """return md5sum of a file."""
-  hasher = hashlib.md5()
   with open(filepath, 'rb') as infile:
-    for chunk in util.chunk_reader(infile):
-      hasher.update(chunk)
-  return hasher.hexdigest()
+    # NOTE(josh): an empty file can't be mapped, and anything which reports a
+    # size of zero (i.e. procfs) might not actually be empty, so read those in
+    # chunks.
+    if os.fstat(infile.fileno()).st_size == 0:
+      hasher = hashlib.md5()
+      for chunk in util.chunk_reader(infile, MEGABYTE):
+        hasher.update(chunk)
+      return hasher.hexdigest()
+
+    mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      # NOTE(josh): madvise() is only available in python >= 3.8
+      if hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+      return hashlib.md5(mapped).hexdigest()
+    finally:
+      mapped.close()
 
 
-def extract_deb(deb_path, rootfs):
+# NOTE(josh): hashing a conffile in python is much cheaper than starting a
+# process, so only defer to `md5sum` once there are enough files to amortize
+# the cost of the exec.
+MD5SUM_BATCH_MIN = 8
+
+
+def md5sum_files(filepaths):
   """
-  Extract a debian package into rootfs. Replicates dpkg --install up to the
-  point of running post-instalation scripts. Extracted packages must be
-  configured later with dpkg --configure.
+  Return a list of md5sums, one for each file in ``filepaths``. If there are
+  many files they are hashed with a single call to ``md5sum``.
+  """
+  if len(filepaths) < MD5SUM_BATCH_MIN:
+    return [md5sum_file(filepath) for filepath in filepaths]
 
-  Implementors note: logic was copied from multistrap as a reference, not dpkg,
-  so there may be some subtle differences.
+  output = util.wrap_subprocess(subprocess.check_output,
+                                ['md5sum', '--'] + filepaths,
+                                env={'LC_ALL': 'C'})
+  # NOTE(josh): md5sum writes one line per file, in order. The line is
+  # prefixed with a backslash if the filename needed escaping.
+  md5sums = [line.lstrip('\\').split(' ', 1)[0]
+             for line in output.splitlines()]
+  assert len(md5sums) == len(filepaths), \
+      "md5sum returned {} hashes for {} files".format(len(md5sums),
+                                                      len(filepaths))
+  return md5sums
 
-  `deb_pat`: path to XXX.deb file to extract
-  `rootfs`: root directory of the filesystem to extract to
+
+# Prefix of the temporary directories, within <rootfs>/var/lib/dpkg, into which
+# extract_payload() unpacks control files
+CONTROL_DIR_PREFIX = 'buntstrap-control-'
+
+
+def extract_payload(deb_path, rootfs):
+  """
+  Extract the filesystem tree of a debian package into rootfs, write out its
+  file list, and unpack its control files into a temporary directory. This is
+  the part of ``extract_deb`` which doesn't touch the shared dpkg database
+  files, so it may be run for many packages concurrently.
+
+  Returns a tuple of ``(package, control_dir, conflines)`` where
+  ``control_dir`` is the temporary directory of control files and
+  ``conflines`` is a list of ``(filepath, md5sum)`` pairs, one for each
+  conffile of the package. Pass these on to ``merge_control``.
   """
 
   package = get_deb_item(deb_path, 'Package')
   info_dir = os.path.join(rootfs, 'var/lib/dpkg/info')
   list_path = os.path.join(info_dir, '{}.list'.format(package))
-  available_path = os.path.join(rootfs, 'var/lib/dpkg/available')
-  status_path = os.path.join(rootfs, 'var/lib/dpkg/status')
 
   try:
     os.makedirs(info_dir)
   except OSError:
     pass
 
+  # NOTE(josh): `dpkg -x` and `dpkg -e` just exec dpkg-deb, so call it
+  # directly and skip the extra process.
   with open(list_path, 'w') as listfile:
-    dpkg_cmd = ['dpkg', '-x', deb_path, rootfs]
+    dpkg_cmd = ['dpkg-deb', '--extract', deb_path, rootfs]
     dpkg_proc = util.wrap_subprocess(subprocess.Popen, dpkg_cmd,
                                      env={'LC_ALL': 'C'},
                                      stdout=subprocess.PIPE)
-    for line in dpkg_proc.stdout:
-      listfile.write(line)
+    shutil.copyfileobj(dpkg_proc.stdout, listfile, MEGABYTE)
     dpkg_proc.stdout.close()
     dpkg_proc.wait()
     assert dpkg_proc.returncode == 0, \
         "command exited with {}: {}".format(dpkg_proc.returncode,
                                             util.quote_args(dpkg_cmd))
 
-  control_dir = tempfile.mkdtemp()
+  # NOTE(josh): create the temporary directory within the target filesystem so
+  # that maintainer scripts can be moved, rather than copied, into place.
+  control_dir = tempfile.mkdtemp(prefix=CONTROL_DIR_PREFIX,
+                                 dir=os.path.join(rootfs, 'var/lib/dpkg'))
+  try:
+    conflines = read_control(deb_path, rootfs, control_dir)
+  except:  # pylint:disable=bare-except
+    # NOTE(josh): control_dir is inside the image, don't leave it behind
+    shutil.rmtree(control_dir, ignore_errors=True)
+    raise
+  return package, control_dir, conflines
+
+
+def read_control(deb_path, rootfs, control_dir):
+  """
+  Unpack the control files of a debian package into ``control_dir`` and return
+  a list of ``(filepath, md5sum)`` pairs, one for each conffile of the package
+  as extracted into ``rootfs``.
+  """
   util.wrap_subprocess(subprocess.check_call,
-                       ['dpkg', '-e', deb_path, control_dir],
+                       ['dpkg-deb', '--control', deb_path, control_dir],
                        env={'LC_ALL': 'C'})
 
+  conffiles = []
+  conffiles_path = os.path.join(control_dir, 'conffiles')
+  if os.path.exists(conffiles_path):
+    with open(conffiles_path, 'r') as infile:
+      for filepath in infile:
+        filepath = filepath.strip()
+        if filepath:
+          conffiles.append(filepath)
+
+  md5sums = md5sum_files([os.path.join(rootfs, filepath.lstrip('/'))
+                          for filepath in conffiles])
+  return list(zip(conffiles, md5sums))
+
+
+def merge_control(rootfs, package, control_dir, conflines):
+  """
+  Register a package extracted by ``extract_payload`` with the dpkg database in
+  rootfs: append its control stanza to the ``available`` and ``status`` files
+  and move its maintainer scripts into place. The temporary ``control_dir`` is
+  removed afterward. This appends to shared files so it must be called for one
+  package at a time.
+  """
+
+  info_dir = os.path.join(rootfs, 'var/lib/dpkg/info')
+  available_path = os.path.join(rootfs, 'var/lib/dpkg/available')
+  status_path = os.path.join(rootfs, 'var/lib/dpkg/status')
+
   with open(available_path, 'a') as available:
     with open(status_path, 'a') as status:
-      conflines = []
       for mscript in os.listdir(control_dir):
         mscript_path = os.path.join(control_dir, mscript)
         if mscript == 'control':
@@ -163,14 +480,7 @@ def extract_deb(deb_path, rootfs):
           status.write('Status: install ok unpacked\n')
         else:
           filename = '{}.{}'.format(package, mscript)
-          shutil.copy2(mscript_path, os.path.join(info_dir, filename))
-          if mscript == 'conffiles':
-            with open(mscript_path, 'r') as infile:
-              for filepath in infile:
-                filepath = filepath.strip()
-                if filepath:
-                  confile_path = os.path.join(rootfs, filepath.lstrip('/'))
-                  conflines.append((filepath, md5sum_file(confile_path)))
+          os.rename(mscript_path, os.path.join(info_dir, filename))
 
       if conflines:
         status.write('Conffiles:\n')
@@ -181,6 +491,31 @@ def extract_deb(deb_path, rootfs):
   shutil.rmtree(control_dir)
 
 
+def extract_deb(deb_path, rootfs):
+  """
+  Extract a debian package into rootfs. Replicates dpkg --install up to the
+  point of running post-instalation scripts. Extracted packages must be
+  configured later with dpkg --configure.
+
+  Implementors note: logic was copied from multistrap as a reference, not dpkg,
+  so there may be some subtle differences.
+
+  `deb_pat`: path to XXX.deb file to extract
+  `rootfs`: root directory of the filesystem to extract to
+  """
+
+  package, control_dir, conflines = extract_payload(deb_path, rootfs)
+  merge_control(rootfs, package, control_dir, conflines)
+
+
+def _extract_payload_star(args):
+  """
+  Unpack the argument tuple for ``extract_payload``. Used with
+  ``multiprocessing.Pool.imap`` which only passes a single argument.
+  """
+  return extract_payload(*args)
+
+
 def filter_obsolete_packages(deb_list):
   """
   Given a list of paths to debian package files, find any package in the list
@@ -193,32 +528,33 @@ def filter_obsolete_packages(deb_list):
   package_map = {}
 
   for deb in deb_list:
-    package, version = get_deb_info(deb, 'Package', 'Version')
+    package, version = get_deb_fields(deb, 'Package', 'Version')
     _, version_in_map = package_map.get(package, (None, None))
     if version_in_map is None:
       package_map[package] = (deb, version)
+    elif version_is_newer(version, version_in_map):
+      package_map[package] = (deb, version)
+      logging.warn('Skipping obsolete %s %s, superceded by %s\n', package,
+                   version_in_map, version)
     else:
-      dpkg_cmd = ['dpkg', '--compare-versions', version, 'gt', version_in_map]
-      if subprocess.call(dpkg_cmd):
-        package_map[package] = (deb, version)
-        logging.warn('Skipping obsolete %s %s, superceded by %s\n', package,
-                     version_in_map, version)
-      else:
-        logging.warn('Skipping obsolete %s %s, superceded by %s\n', package,
-                     version, version_in_map)
+      logging.warn('Skipping obsolete %s %s, superceded by %s\n', package,
+                   version, version_in_map)
 
   return sorted(deb for deb, _ in package_map.values())
 
 
+# NOTE(josh): carriage return followed by the ANSI "erase to end of line"
+# sequence, used to overwrite progress messages in place
+CLEAR_LINE = '\r\x1b[K'
+
+
 def get_file_size(file_path):
   """
   Get the size, in bytes of a file. Note that this size includes 'holes' as
   if they were filled. Specifically it is equal to the file offset of the
   last byte addressable in the file.
   """
-  with open(file_path, 'rb') as infile:
-    infile.seek(0, 2)
-    return infile.tell()
+  return os.stat(file_path).st_size
 
 
 def get_apt_report(deblist):
@@ -227,23 +563,17 @@ def get_apt_report(deblist):
   (package_name, packaged_size, installed_size, description)
   """
 
+  prefetch_deb_info(deblist)
   report = []
-  prev_msg_len = 0
   last_print_time = 0
   for idx, deb_path in enumerate(deblist):
+    package_name = get_deb_item(deb_path, 'Package')
     if time.time() - last_print_time > 0.5:
-      msg = '\rGeneratingReport [{:6.2f}%]:{:20s}'.format(
-          100.0 * (idx + 1) / len(deblist),
-          get_deb_item(deb_path, 'Package'))
-      sys.stdout.write('\r')
-      sys.stdout.write(' ' * prev_msg_len)
-      sys.stdout.write('\r')
-      sys.stdout.write(msg)
+      sys.stdout.write(CLEAR_LINE + 'GeneratingReport [{:6.2f}%]:{:20s}'.format(
+          100.0 * (idx + 1) / len(deblist), package_name))
       sys.stdout.flush()
-      prev_msg_len = len(msg)
       last_print_time = time.time()
 
-    package_name = get_deb_item(deb_path, 'Package')
     package_version = get_deb_item(deb_path, 'Version')
     package_size = get_file_size(deb_path)
     try:
@@ -258,11 +588,21 @@ def get_apt_report(deblist):
     report.append((package_name, package_size, installed_size, description,
                    package_version))
 
-  sys.stdout.write('\rGenerating Report [100.00%]\n')
+  sys.stdout.write(CLEAR_LINE + 'Generating Report [100.00%]\n')
   return report
 
 
-def unpack_archives(rootfs, deb_list):
+def remove_control_dirs(dpkg_dir):
+  """
+  Remove any temporary control directories created by ``extract_payload``
+  which were not consumed by ``merge_control``.
+  """
+  for name in os.listdir(dpkg_dir):
+    if name.startswith(CONTROL_DIR_PREFIX):
+      shutil.rmtree(os.path.join(dpkg_dir, name), ignore_errors=True)
+
+
+def unpack_archives(rootfs, deb_list, jobs=1):
   """
   Extract a debian package into rootfs the same way that multistrap would.
   According to the documentation this is the same set of steps dpkg would do
@@ -272,10 +612,16 @@ def unpack_archives(rootfs, deb_list):
 
   ``deb_list``: list of paths to `.deb` files that are to be installed in the
   ``rootfs``.
+
+  ``jobs``: number of packages to extract concurrently. With more than one
+  job, the contents of paths shipped by more than one package depend on which
+  extraction finishes last. With one job, the later package in ``deb_list``
+  always wins.
   """
 
   unfiltered_len = len(deb_list)
   logging.info('I have %s archives to unpackage', unfiltered_len)
+  prefetch_deb_info(deb_list)
   deb_list = filter_obsolete_packages(deb_list)
   if len(deb_list) != unfiltered_len:
     logging.info('Filtered down to %s', len(deb_list))
@@ -286,23 +632,40 @@ def unpack_archives(rootfs, deb_list):
   except OSError:
     pass
 
-  prev_msg_len = 0
-  last_print_time = 0
-  for idx, deb_path in enumerate(deb_list):
-    if time.time() - last_print_time > 0.5:
-      msg = '\rUnpacking [{:6.2f}%]:{:20s}'.format(
-          100.0 * (idx + 1) / len(deb_list),
-          get_deb_item(deb_path, 'Package'))
-      sys.stdout.write('\r')
-      sys.stdout.write(' ' * prev_msg_len)
-      sys.stdout.write('\r')
-      sys.stdout.write(msg)
-      sys.stdout.flush()
-      prev_msg_len = len(msg)
-      last_print_time = time.time()
-    extract_deb(deb_path, rootfs)
+  # NOTE(josh): with a pool of worker processes, the results are still
+  # consumed in the order of deb_list, so that writes to the dpkg database
+  # happen serially and in the same order as they do without one.
+  pool = None
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs)
+    payloads = pool.imap(_extract_payload_star,
+                         [(deb_path, rootfs) for deb_path in deb_list])
+  else:
+    payloads = (extract_payload(deb_path, rootfs) for deb_path in deb_list)
 
-  sys.stdout.write('\rUnpacking [100.00%]\n')
+  succeeded = False
+  try:
+    last_print_time = 0
+    for idx, (package, control_dir, conflines) in enumerate(payloads):
+      if time.time() - last_print_time > 0.5:
+        sys.stdout.write(CLEAR_LINE + 'Unpacking [{:6.2f}%]:{:20s}'.format(
+            100.0 * (idx + 1) / len(deb_list), package))
+        sys.stdout.flush()
+        last_print_time = time.time()
+      merge_control(rootfs, package, control_dir, conflines)
+    succeeded = True
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+    # NOTE(josh): payloads that were in flight or extracted but not yet merged
+    # leave their control directories behind
+    if not succeeded:
+      remove_control_dirs(dpkg_dir)
+
+  sys.stdout.write(CLEAR_LINE + 'Unpacking [100.00%]\n')
+  # NOTE(josh): control fields are only needed up through extraction
+  _deb_info_cache.clear()
 
 
 def get_apt_archives_plus(rootfs, external_debs=None):
@@ -322,16 +685,118 @@ def get_apt_archives_plus(rootfs, external_debs=None):
   return deblist
 
 
+HUNK_HEADER_REGEX = re.compile(r'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+
+
+def parse_unified_diff(patch_text):
+  """
+  Parse the text of a unified diff. Returns a list of ``(path, hunks)`` pairs,
+  one for each file in the diff, where ``path`` is the target path from the
+  ``+++`` line and each hunk is a pair of lists ``(old_lines, new_lines)``.
+  """
+
+  files = []
+  lines = iter(patch_text.splitlines())
+  for line in lines:
+    if line.startswith('+++ '):
+      # NOTE(josh): the path may be followed by a timestamp
+      files.append((line[4:].split()[0], []))
+      continue
+
+    match = HUNK_HEADER_REGEX.match(line)
+    if not match or not files:
+      continue
+
+    old_count = int(match.group(1) or 1)
+    new_count = int(match.group(2) or 1)
+    old_lines = []
+    new_lines = []
+    while len(old_lines) < old_count or len(new_lines) < new_count:
+      line = next(lines, None)
+      if line is None:
+        raise ValueError('Unexpected end of patch in hunk of {}'
+                         .format(files[-1][0]))
+      if line.startswith('\\'):
+        continue
+      elif line.startswith('-'):
+        old_lines.append(line[1:])
+      elif line.startswith('+'):
+        new_lines.append(line[1:])
+      else:
+        # NOTE(josh): an empty line is empty context, some editors strip the
+        # leading space.
+        old_lines.append(line[1:])
+        new_lines.append(line[1:])
+    files[-1][1].append((old_lines, new_lines))
+
+  return files
+
+
+def find_sublist(haystack, needle):
+  """
+  Return the index of the first occurrence of the list ``needle`` within the
+  list ``haystack``, or -1 if it does not occur.
+  """
+  for idx in range(len(haystack) - len(needle) + 1):
+    if haystack[idx:idx + len(needle)] == needle:
+      return idx
+  return -1
+
+
+def apply_patch_exact(patch_text, apply_dir):
+  """
+  Attempt to apply the patch to the specified directory in python. Paths in
+  the patch are relative to ``apply_dir`` (i.e. ``patch -p0``). Hunks which
+  are already applied are skipped (i.e. ``patch --forward``). Context must
+  match exactly. Returns false, without modifying any files, if some hunk
+  neither applies nor is already applied.
+  """
+
+  patched = []
+  for relpath, hunks in parse_unified_diff(patch_text):
+    target_path = os.path.join(apply_dir, relpath)
+    with open(target_path, 'r') as infile:
+      content = infile.read().split('\n')
+
+    modified = False
+    for hunk_idx, (old_lines, new_lines) in enumerate(hunks):
+      offset = find_sublist(content, old_lines)
+      if offset != -1:
+        content[offset:offset + len(old_lines)] = new_lines
+        modified = True
+      elif find_sublist(content, new_lines) != -1:
+        logging.info('Hunk #%d of %s is already applied, skipping',
+                     hunk_idx + 1, relpath)
+      else:
+        logging.info('Hunk #%d of %s does not match exactly',
+                     hunk_idx + 1, relpath)
+        return False
+
+    if modified:
+      patched.append((target_path, content))
+
+  for target_path, content in patched:
+    with open(target_path, 'w') as outfile:
+      outfile.write('\n'.join(content))
+  return True
+
+
 def apply_patch_text(patch_text, apply_dir):
   """
   Attempt to apply the patch to the specified directory. Fail if the patch
-  doesn't apply cleanly.
+  doesn't apply cleanly. The common case of context which matches exactly is
+  handled in python, otherwise fall back to the ``patch`` program, which
+  tolerates some fuzz.
   """
+  if apply_patch_exact(patch_text, apply_dir):
+    return
+
   patch_proc = subprocess.Popen(['patch', '-d', apply_dir, '-p0', '--forward',
                                  '--reject-file=/dev/null'],
                                 stdin=subprocess.PIPE,
                                 stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
   stdout_text, stderr_text = patch_proc.communicate(patch_text)
   if stdout_text:
     logging.info(stdout_text)
@@ -371,6 +836,60 @@ BASE_FILES_PATCH = """
    fi
 """
 
+# NOTE(josh): a line introduced by BASE_FILES_PATCH, if it is present then the
+# patch has already been applied
+BASE_FILES_PATCH_SENTINEL = '`ls -A $1/`'
+
+
+def append_package_depends(status_path, package, depends):
+  """
+  Edit the dpkg status file at ``status_path`` in place, appending ``depends``
+  to the ``Depends:`` field of ``package``. Does nothing if the package isn't
+  listed, has no ``Depends:`` field, or already depends on ``depends``.
+  """
+
+  package_text = 'Package: {}\n'.format(package)
+  field_text = '\nDepends: '
+  append_text = ', ' + depends
+
+  with open(status_path, 'r+b') as statusfile:
+    size = os.fstat(statusfile.fileno()).st_size
+    # NOTE(josh): can't mmap an empty file
+    if size == 0:
+      return
+
+    mapped = mmap.mmap(statusfile.fileno(), 0)
+    try:
+      if mapped[:len(package_text)] == package_text:
+        stanza_begin = 0
+      else:
+        stanza_begin = mapped.find('\n' + package_text)
+        if stanza_begin == -1:
+          return
+
+      stanza_end = mapped.find('\n\n', stanza_begin + 1)
+      if stanza_end == -1:
+        stanza_end = size
+
+      field_begin = mapped.find(field_text, stanza_begin, stanza_end)
+      if field_begin == -1:
+        return
+
+      field_end = mapped.find('\n', field_begin + 1)
+      if field_end == -1:
+        field_end = size
+
+      value = mapped[field_begin + len(field_text):field_end]
+      if depends in [dep.split()[0] for dep in value.split(',') if dep.strip()]:
+        return
+
+      mapped.resize(size + len(append_text))
+      mapped.move(field_end + len(append_text), field_end, size - field_end)
+      mapped[field_end:field_end + len(append_text)] = append_text
+      mapped.flush()
+    finally:
+      mapped.close()
+
 
 def tweak_new_filesystem(root_dir):
   """
@@ -403,29 +922,14 @@ def tweak_new_filesystem(root_dir):
   basefiles_path = os.path.join(root_dir,
                                 'var/lib/dpkg/info/base-files.postinst')
   if os.path.exists(basefiles_path):
-    apply_patch_text(BASE_FILES_PATCH, root_dir)
+    with open(basefiles_path, 'r') as infile:
+      already_patched = BASE_FILES_PATCH_SENTINEL in infile.read()
+    if not already_patched:
+      apply_patch_text(BASE_FILES_PATCH, root_dir)
 
   # NOTE(josh): ifupdown should depend on initscripts, but it doesn't
-  status_path = os.path.join(root_dir, 'var/lib/dpkg/status')
-  tempfile_path = status_path + '.tmp'
-  with open(tempfile_path, 'wb') as outfile:
-    with open(status_path, 'rb') as infile:
-      for line in infile:
-        outfile.write(line)
-        if line.strip() == 'Package: ifupdown':
-          break
-
-      for line in infile:
-        if line.startswith('Depends: '):
-          line = ', '.join(line.strip().split(', ') + ['initscripts']) + '\n'
-          outfile.write(line)
-          break
-        else:
-          outfile.write(line)
-
-      for line in infile:
-        outfile.write(line)
-    os.rename(tempfile_path, status_path)
+  append_package_depends(os.path.join(root_dir, 'var/lib/dpkg/status'),
+                         'ifupdown', 'initscripts')
 
   # NOTE(josh): resolvconf tries to a write a file in this directory
   try:
@@ -530,7 +1034,7 @@ def install_pip_packages(chroot_app, rootfs, package_list):
 
   paths_to_remove = ['root/.cache/pip']
   for path in paths_to_remove:
-    subprocess.check_call(['rm', '-rf', os.path.join(rootfs, path)])
+    shutil.rmtree(os.path.join(rootfs, path), ignore_errors=True)
 
 
 def initialize_rootfs(rootfs_dir, apt_sources):
@@ -542,12 +1046,12 @@ def initialize_rootfs(rootfs_dir, apt_sources):
   if not os.path.exists(lib64_path):
     force_symlink('lib', lib64_path)
 
-  for mkdir in ['etc/apt',
-                'etc/apt/sources.list.d',
+  # NOTE(josh): only leaf directories are listed, their parents (e.g. etc/apt,
+  # var/lib/dpkg) are created along the way by makedirs.
+  for mkdir in ['etc/apt/sources.list.d',
                 'etc/apt/preferences.d',
                 'var/cache/apt/archives/partial',
                 'var/cache/debconf',
-                'var/lib/dpkg',
                 'var/lib/dpkg/alternatives',
                 'var/lib/dpkg/info',
                 'var/lib/dpkg/parts',
@@ -567,8 +1071,8 @@ def initialize_rootfs(rootfs_dir, apt_sources):
                      'var/lib/dpkg/lock',
                      'var/lib/dpkg/statoverride',
                      'var/lib/dpkg/status', ]:
-    with open(os.path.join(rootfs_dir, touch_path), 'w') as _:
-      pass
+    os.close(os.open(os.path.join(rootfs_dir, touch_path),
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666))
 
 
 def rfc822_parse(infile):
@@ -616,6 +1120,18 @@ def rfc822_parse(infile):
     yield result
 
 
+def iter_package_index(infile):
+  """
+  Return a generator over the package stanzas of an apt package index file.
+  Uses the C parser from python-apt if it is available, otherwise falls back to
+  ``rfc822_parse``.
+  """
+  apt_pkg = get_apt_pkg()
+  if apt_pkg is None:
+    return rfc822_parse(infile)
+  return apt_pkg.TagFile(infile)
+
+
 def get_default_packages(rootfs, include_essential=False,
                          include_priorities=None):
   """
@@ -632,7 +1148,7 @@ def get_default_packages(rootfs, include_essential=False,
       continue
 
     with open(os.path.join(list_dir, filename)) as infile:
-      for pkg in rfc822_parse(infile):
+      for pkg in iter_package_index(infile):
         if 'Essential' in pkg and include_essential:
           package_list.add(pkg['Package'])
           continue
@@ -691,19 +1207,22 @@ def iter_mounts():
   options).
   """
   with open('/proc/mounts', 'r') as mounts:
-    for line in mounts.readlines():
-      (device, mountpoint, filesystem,
-       options, _, _) = line.decode('UTF-8').split()
-      yield (device, mountpoint, filesystem, options)
+    for line in mounts:
+      yield tuple(line.split()[:4])
 
 
 def get_device_mounted_at(query_path):
   """Return the device file mounted at the given path if it is a mount point."""
 
+  try:
+    query_stat = os.stat(query_path)
+  except OSError:
+    return None
+
   # pylint: disable=unused-variable
   for device, mountpoint, filesystem, options in iter_mounts():
     try:
-      if os.path.samefile(mountpoint, query_path):
+      if os.path.samestat(os.stat(mountpoint), query_stat):
         return device
     except OSError:
       continue
@@ -711,18 +1230,41 @@ def get_device_mounted_at(query_path):
   return None
 
 
+@util.memoize
 def get_apt_version():
   """
-  Execute ``apt-get --version`` and parse the result to get a list of integers
-  used to identify the apt version number.
+  Return a list of integers used to identify the apt version number. If
+  python-apt is available this is the version of the apt library it is bound
+  to, otherwise execute ``apt-get --version`` and parse the result. The result
+  is cached so apt-get is only executed once per process.
   """
-  version_output = util.print_and(subprocess.check_output,
-                                  ['apt-get', '--version']).strip()
-  firstline = version_output.splitlines()[0]
-  version_number = firstline.split()[1]
+  apt_pkg = get_apt_pkg()
+  if apt_pkg is not None:
+    version_number = apt_pkg.VERSION
+  else:
+    version_output = util.print_and(subprocess.check_output,
+                                    ['apt-get', '--version']).strip()
+    firstline = version_output.splitlines()[0]
+    version_number = firstline.split()[1]
+
+  # NOTE(josh): ignore any distribution suffix (e.g. 1.2.24ubuntu1)
+  version_number = re.match(r'[\d.]*', version_number).group().strip('.')
   return [int(part) for part in version_number.split('.')]
 
 
+def normalize_package_spec(package_spec, arch):
+  """
+  Strip the architecture qualifier from an apt package specification (e.g.
+  ``libc6:amd64=2.23-0ubuntu10``) if it is the native architecture ``arch``,
+  so that equivalent specifications compare equal.
+  """
+  name, sep, version = package_spec.partition('=')
+  arch_suffix = ':' + arch
+  if name.endswith(arch_suffix):
+    name = name[:-len(arch_suffix)]
+  return name + sep + version
+
+
 def create_rootfs(config):
 
   try:
@@ -747,8 +1289,9 @@ def create_rootfs(config):
                                             config.apt_include_priorities)
     if config.pip_packages:
       default_packages.append('python-pip')
-    apt_package_list = list(sorted(set(config.apt_packages
-                                       + default_packages)))
+    apt_package_list = list(sorted(set(
+        normalize_package_spec(package_spec, config.architecture)
+        for package_spec in config.apt_packages + default_packages)))
 
     apt_version = get_apt_version()
     if apt_version >= [1, 2, 24]:
@@ -783,7 +1326,7 @@ def create_rootfs(config):
     logging.info('skipping size-report')
 
   if config.is_enabled('dpkg-extract'):
-    unpack_archives(config.rootfs, deblist)
+    unpack_archives(config.rootfs, deblist, config.dpkg_extract_jobs)
   else:
     logging.info('skipping dpkg-extract')
 
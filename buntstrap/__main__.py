@@ -5,10 +5,12 @@ Bootstrap an ubuntu rootfs.
 import argparse
 import io
 import logging
+import os
 import sys
 
 import buntstrap
 from buntstrap import config
+from buntstrap import util
 
 VERSION = "0.1.4"
 
@@ -19,13 +21,35 @@ default. If you wish to suppress this behavior, then specify
 """
 
 
-def main():
-  format_str = '%(levelname)-6s %(filename)s[%(lineno)-3s] : %(message)s'
-  logging.basicConfig(level=logging.INFO,
-                      format=format_str,
-                      datefmt='%Y-%m-%d %H:%M:%S',
-                      filemode='w')
+@util.memoize
+def compile_config_source(config_path, mtime, size):
+  """
+  Return the code object compiled from the config file at ``config_path``. The
+  ``mtime`` and ``size`` of the file are only used as part of the cache key.
+  """
+  # pylint: disable=unused-argument
+  with io.open(config_path, 'r', encoding='utf8') as infile:
+    return compile(infile.read(), config_path, 'exec')
+
+
+def compile_config(config_path):
+  """
+  Return the code object for the config file at ``config_path``. Compiled
+  configs are cached until the file is modified.
+  """
+  config_stat = os.stat(config_path)
+  return compile_config_source(config_path, config_stat.st_mtime,
+                               config_stat.st_size)
+
 
+@util.memoize
+def build_parser():
+  """
+  Construct the command line parser. Returns a tuple of
+  ``(parser, default_dict)`` where ``default_dict`` is the serialized default
+  configuration from which the config flags were generated. The result is
+  cached, since building the defaults requires probing the host.
+  """
   parser = argparse.ArgumentParser(description=__doc__)
 
   parser.add_argument('-v', '--version', action='version',
@@ -45,6 +69,17 @@ def main():
     config.add_to_argparse(parser, key, value)
   parser.add_argument('rootfs', nargs='?',
                       help='path of the rootfs to bootstrap')
+  return parser, default_dict
+
+
+def main():
+  format_str = '%(levelname)-6s %(filename)s[%(lineno)-3s] : %(message)s'
+  logging.basicConfig(level=logging.INFO,
+                      format=format_str,
+                      datefmt='%Y-%m-%d %H:%M:%S',
+                      filemode='w')
+
+  parser, default_dict = build_parser()
   args = parser.parse_args()
   if args.dump_config:
     config.dump_config(sys.stdout)
@@ -54,9 +89,8 @@ def main():
 
   config_dict = {}
   if args.config:
-    with io.open(args.config, 'r', encoding='utf8') as infile:
-      # pylint: disable=W0122
-      exec(infile.read(), config_dict)
+    # pylint: disable=W0122
+    exec(compile_config(args.config), config_dict)
 
   # NOTE(josh): command line arguments override configuration file options,
   # but only if they are actually specified (i.e. not None)
@@ -1,10 +1,12 @@
 
+import ctypes
 import enum
 import logging
 import os
 import shutil
 import stat
 import subprocess
+import sys
 
 from buntstrap import util
 
@@ -19,6 +21,70 @@ class Type(enum.Enum):
   UCHROOT = 4
 
 
+# NOTE(josh): don't walk and close every inherited file descriptor when
+# spawning a child process. Nothing we run relies on descriptors being closed,
+# and this skips the per-descriptor close loop in the child.
+SPAWN_KWARGS = {'close_fds': False}
+
+
+# From <sys/mount.h>
+MS_BIND = 4096
+
+
+@util.memoize
+def get_libc():
+  """
+  Return a handle to the C library already loaded into this process.
+  """
+  return ctypes.CDLL(None, use_errno=True)
+
+
+def encode_path(path):
+  """
+  Return ``path`` as a byte string suitable for passing to libc.
+  """
+  if isinstance(path, bytes):
+    return path
+  return path.encode(sys.getfilesystemencoding())
+
+
+def bind_mount(source, dest):
+  """
+  Bind mount ``source`` at ``dest`` by calling mount(2) directly, rather than
+  spawning a ``mount -o bind`` process.
+  """
+  logging.debug('mount -o bind %s %s', source, dest)
+  result = get_libc().mount(encode_path(source), encode_path(dest), None,
+                            ctypes.c_ulong(MS_BIND), None)
+  if result != 0:
+    errnum = ctypes.get_errno()
+    raise OSError(errnum, 'Failed to bind {} at {}: {}'
+                  .format(source, dest, os.strerror(errnum)))
+
+
+def umount(dest):
+  """
+  Unmount the filesystem mounted at ``dest`` by calling umount2(2) directly,
+  rather than spawning a ``umount`` process.
+  """
+  logging.debug('umount %s', dest)
+  result = get_libc().umount2(encode_path(dest), 0)
+  if result != 0:
+    errnum = ctypes.get_errno()
+    raise OSError(errnum, 'Failed to unmount {}: {}'
+                  .format(dest, os.strerror(errnum)))
+
+
+@util.memoize
+def cached_realpath(path):
+  """
+  Return ``os.path.realpath(path)`` for the absolute path ``path``. Bind
+  sources are the same for every chroot context in a run, so each one is only
+  resolved once.
+  """
+  return os.path.realpath(path)
+
+
 class AppBase(object):
   """
   Base class for chroot implementations
@@ -41,11 +107,14 @@ class AppBase(object):
     self.binds = binds
     self.qemu_binary = qemu_binary
     self.wheelhouse = wheelhouse
+    # NOTE(josh): filled by __enter__() and reused by __exit__() so that the
+    # bind sources are only resolved once per context
+    self.resolved_binds = ()
 
   def _update_kwargs(self, kwargs):
     """
-    Merge the requested environment with the base environment, and set
-    the preexec_fn if base class requested it
+    Merge the requested environment with the base environment, set
+    the preexec_fn if base class requested it, and apply SPAWN_KWARGS
     """
     if 'env' in kwargs:
       env = dict(kwargs['env'])
@@ -57,6 +126,9 @@ class AppBase(object):
     if self.preexec_fn is not None:
       kwargs['preexec_fn'] = self.preexec_fn
 
+    for key, value in SPAWN_KWARGS.items():
+      kwargs.setdefault(key, value)
+
   def popen(self, cmd, *args, **kwargs):
     self._update_kwargs(kwargs)
     return util.print_and(subprocess.Popen, self.cmd + cmd, *args, **kwargs)
@@ -75,13 +147,21 @@ class AppBase(object):
     return util.print_and(subprocess.check_output, self.cmd + cmd,
                           *args, **kwargs)
 
-  def iterbinds(self):
+  def iterbinds(self, resolve=True):
     """
     Given a list of bind specifications, return a generator that iterates over
-    (source, dest) pairs where ``source`` is an absolute path on the host
-    filesystem and ``dest`` is a relative path within the target filesystem.
+    (source, dest, source_stat) tuples where ``source`` is an absolute path on
+    the host filesystem, ``dest`` is a relative path within the target
+    filesystem, and ``source_stat`` is the ``os.stat()`` result for
+    ``source``, or None if ``source`` doesn't exist. If ``resolve`` is false
+    then symlinks in ``source`` are left for the caller to resolve. The
+    wheelhouse, if any, is bound at ``opt/wheelhouse``.
     """
-    for bind in self.binds:
+    binds = list(self.binds)
+    if self.wheelhouse:
+      binds.append((self.wheelhouse, 'opt/wheelhouse'))
+
+    for bind in binds:
       if isinstance(bind, (tuple, list)):
         source, dest = bind
       elif ':' in bind:
@@ -89,34 +169,45 @@ class AppBase(object):
       else:
         source = dest = bind
 
-      yield (os.path.realpath(source), dest.lstrip('/'))
-
-    if self.wheelhouse:
-      yield (os.path.realpath(source), 'opt/wheelhouse')
+      try:
+        if resolve:
+          # NOTE(josh): source is fully resolved so lstat() is the same as
+          # stat()
+          source = cached_realpath(os.path.abspath(source))
+          source_stat = os.lstat(source)
+        else:
+          source = os.path.abspath(source)
+          source_stat = os.stat(source)
+      except OSError:
+        # NOTE(josh): a missing source is neither a file nor a directory, which
+        # callers treat the same as a device node
+        source_stat = None
+      yield (source, dest.lstrip('/'), source_stat)
 
   def __enter__(self):
-    for source, dest in self.iterbinds():
+    self.resolved_binds = tuple(self.iterbinds())
+    for source, dest, source_stat in self.resolved_binds:
       dest = os.path.join(self.rootfs, dest)
+      mode = getattr(source_stat, 'st_mode', 0)
 
-      if stat.S_ISREG(os.stat(source).st_mode):
+      if stat.S_ISREG(mode):
         logging.debug('cp %s -> %s', source, dest)
-        shutil.copy2(source, dest)
-      elif os.path.isdir(source):
-        if not os.path.exists(dest):
-          logging.debug('mkdir %s', dest)
-          os.makedirs(dest)
+        shutil.copy(source, dest)
+      elif stat.S_ISDIR(mode):
+        logging.debug('mkdir %s', dest)
+        util.makedirs(dest)
       else:
         pardir = os.path.dirname(dest)
-        if not os.path.exists(pardir):
-          logging.debug('mkdir %s', pardir)
-          os.makedirs(pardir)
+        logging.debug('mkdir %s', pardir)
+        util.makedirs(pardir)
         with open(dest, 'w') as _:
           pass
 
   def __exit__(self, exc_type, exc_value, traceback):
-    for source, dest in self.iterbinds():
+    for _, dest, source_stat in self.resolved_binds:
       dest = os.path.join(self.rootfs, dest)
-      if stat.S_ISREG(os.stat(source).st_mode):
+      mode = getattr(source_stat, 'st_mode', 0)
+      if stat.S_ISREG(mode):
         os.remove(dest)
 
 
@@ -129,33 +220,32 @@ class PosixApp(AppBase):
     assert os.getuid() == 0, "PosixApp will only work as root!"
 
   def __enter__(self):
-    for source, dest in self.iterbinds():
+    self.resolved_binds = tuple(self.iterbinds())
+    for source, dest, source_stat in self.resolved_binds:
       dest = os.path.join(self.rootfs, dest)
+      mode = getattr(source_stat, 'st_mode', 0)
 
-      if stat.S_ISREG(os.stat(source).st_mode):
-        shutil.copy2(source, dest)
-      elif os.path.isdir(source):
-        if not os.path.exists(dest):
-          os.makedirs(dest)
-        util.print_and(subprocess.check_call,
-                       ['mount', '-o', 'bind', source, dest])
+      if stat.S_ISREG(mode):
+        shutil.copy(source, dest)
+      elif stat.S_ISDIR(mode):
+        util.makedirs(dest)
+        bind_mount(source, dest)
       else:
         pardir = os.path.dirname(dest)
-        if not os.path.exists(pardir):
-          logging.debug('mkdir %s', pardir)
-          os.makedirs(pardir)
+        logging.debug('mkdir %s', pardir)
+        util.makedirs(pardir)
         with open(dest, 'w') as _:
           pass
-        util.print_and(subprocess.check_call,
-                       ['mount', '-o', 'bind', source, dest])
+        bind_mount(source, dest)
 
   def __exit__(self, exc_type, exc_value, traceback):
-    for source, dest in self.iterbinds():
+    for _, dest, source_stat in self.resolved_binds:
       dest = os.path.join(self.rootfs, dest)
-      if stat.S_ISREG(os.stat(source).st_mode):
+      mode = getattr(source_stat, 'st_mode', 0)
+      if stat.S_ISREG(mode):
         os.remove(dest)
       else:
-        util.print_and(subprocess.check_call, ['umount', dest])
+        umount(dest)
 
     return False
 
@@ -170,12 +260,12 @@ class ProotApp(AppBase):
                 '--cwd=/']
     if qemu_binary:
       self.cmd.append('--qemu={}'.format(qemu_binary))
-    if wheelhouse:
-      self.cmd.append('--bind={}:/opt/wheelhouse'.format(wheelhouse))
 
-    for source, dest in self.iterbinds():
-      if os.path.isdir(source):
-        self.cmd.append('-bind={}:/{}'.format(source, dest))
+    # NOTE(josh): proot resolves symlinks in the bind source itself
+    self.cmd.extend('--bind=%s:/%s' % (source, dest)
+                    for source, dest, source_stat
+                    in self.iterbinds(resolve=False)
+                    if stat.S_ISDIR(getattr(source_stat, 'st_mode', 0)))
 
     # If I am not root, then emulate root
     if os.getuid() != 0:
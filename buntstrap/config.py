@@ -3,79 +3,95 @@ Includes definition of the bunstrap configuration class as well as some
 convenience utilities for specifying various configuration options.
 """
 
-import httplib
-import inspect
+import itertools
 import json
 import logging
 import os
-import pprint
+import socket
 import subprocess
 import textwrap
+import types
 
 from buntstrap import chroot
 from buntstrap import util
 
 
+@util.memoize
 def get_host_architecture():
   """
-  Return the dpkg host architecture.
+  Return the dpkg host architecture. The result is cached.
   """
-  return util.wrap_subprocess(subprocess.check_output,
-                              ['dpkg', '--print-architecture']).strip()
+  return subprocess.check_output(['dpkg', '--print-architecture'],
+                                 universal_newlines=True,
+                                 **chroot.SPAWN_KWARGS).strip()
 
 
+@util.memoize
 def get_host_suite():
   """
-  Return the ubuntu host suite
+  Return the ubuntu host suite. The result is cached.
   """
-  return util.wrap_subprocess(subprocess.check_output,
-                              ['lsb_release', '-cs']).strip()
+  return subprocess.check_output(['lsb_release', '-cs'],
+                                 universal_newlines=True,
+                                 **chroot.SPAWN_KWARGS).strip()
 
 
+@util.memoize
 def get_apt_cache_url():
   """
   Return the URL of apt-cacher-ng if it is running locally, or None if it
-  is not.
+  is not. The result is cached, so the probe only happens once per process.
   """
 
   # NOTE(josh): check to see if apt-cacher-ng is running locally. If so, use
   # it to cache apt-get.
-  for url_attempt in ['localhost:3142']:
+  for address, url_attempt in [(('127.0.0.1', 3142), 'localhost:3142')]:
     try:
-      # NOTE(josh): don't use requests so as to limit dependencies
-      http_conn = httplib.HTTPConnection(url_attempt, timeout=1)
-      http_conn.request('GET', '/acng-report.html')
-      response = http_conn.getresponse()
-      if response.status == 200:
-        logging.info('apt-cacher-ng running locally, will use')
-        return 'http://' + url_attempt
-    except Exception:  # pylint: disable=broad-except
-      pass
+      # NOTE(josh): a TCP connect is enough to tell that something is
+      # listening on the apt-cacher-ng port, there's no need for a full HTTP
+      # request/response round trip. Connect to the loopback address
+      # directly so that there's no name lookup either.
+      sock = socket.create_connection(address, timeout=0.1)
+    except socket.error:
+      continue
+    sock.close()
+    logging.info('apt-cacher-ng running locally, will use')
+    return 'http://' + url_attempt
 
   logging.info('apt-cacher-ng not running locally will not use any apt-cache')
   return None
 
 
+# Maps each supported architecture to the ``(arch, ubuntu_url)`` pair used in
+# the bootstrap sources list for that architecture
+ARCH_TABLE = {
+    'amd64': ('amd64,i386', 'http://us.archive.ubuntu.com/ubuntu'),
+    'arm64': ('arm64', 'http://www.ports.ubuntu.com/ubuntu-ports'),
+    'armhf': ('armhf', 'http://www.ports.ubuntu.com/ubuntu-ports'),
+}
+
+
 def get_ubuntu_url(arch):
   """
   Return the ubuntu url for the given suite.
   """
-  if arch in ['armhf', 'arm64']:
-    return 'http://www.ports.ubuntu.com/ubuntu-ports'
-  elif arch == 'amd64':
-    return 'http://us.archive.ubuntu.com/ubuntu'
+  entry = ARCH_TABLE.get(arch, None)
+  if entry is None:
+    return None
+  return entry[1]
 
 
+# NOTE(josh): placeholders are {0}: arch, {1}: ubuntu_url, {2}: suite
 BOOTSTRAP_SOURCES = """
 # NOTE(josh): these sources are used to bootstrap the rootfs and should be
 # omitted from after initial package installation. You should not see this
 # file on a live system.
 
-deb [arch={arch}] {ubuntu_url} {suite} main universe multiverse
-deb [arch={arch}] {ubuntu_url} {suite}-updates main universe multiverse
-deb [arch={arch}] http://ppa.launchpad.net/lttng/stable-2.9/ubuntu {suite} main
-deb [arch={arch}] http://ppa.launchpad.net/nginx/stable/ubuntu {suite} main
-deb [arch={arch}] http://ppa.launchpad.net/webupd8team/java/ubuntu {suite} main
+deb [arch={0}] {1} {2} main universe multiverse
+deb [arch={0}] {1} {2}-updates main universe multiverse
+deb [arch={0}] http://ppa.launchpad.net/lttng/stable-2.9/ubuntu {2} main
+deb [arch={0}] http://ppa.launchpad.net/nginx/stable/ubuntu {2} main
+deb [arch={0}] http://ppa.launchpad.net/webupd8team/java/ubuntu {2} main
 """
 
 
@@ -83,17 +99,14 @@ def get_bootstrap_sources(arch, suite):
   """
   Return default sources for ubuntu given an architecture and suite
   """
-  fmt_args = dict(arch=arch, suite=suite, ubuntu_url=get_ubuntu_url(arch))
-  if arch in ['armhf', 'arm64']:
-    pass
-  elif arch == 'amd64':
-    fmt_args['arch'] = 'amd64,i386'
-  else:
+  if arch not in ARCH_TABLE:
     raise ValueError('Unexpected arch={}'.format(arch))
 
-  return BOOTSTRAP_SOURCES.format(**fmt_args)
+  sources_arch, ubuntu_url = ARCH_TABLE[arch]
+  return BOOTSTRAP_SOURCES.format(sources_arch, ubuntu_url, suite)
 
 
+@util.memoize
 def default_qemu_binary(target_arch):
   """
   Return the path to qemu binary for the target architecture
@@ -112,13 +125,39 @@ def default_qemu_binary(target_arch):
   return None
 
 
+# NOTE(josh): os.scandir() is only available on python 3.5+, on older pythons
+# use the scandir backport if it's installed.
+SCANDIR = getattr(os, 'scandir', None)
+if SCANDIR is None:
+  try:
+    from scandir import scandir as SCANDIR
+  except ImportError:
+    SCANDIR = None
+
+
+def list_first_entries(dirpath, count):
+  """
+  Return the names of at most ``count`` entries of the directory ``dirpath``
+  without reading the rest of the directory, if os.scandir() is available.
+  """
+  if SCANDIR is None:
+    return os.listdir(dirpath)[:count]
+
+  entries = SCANDIR(dirpath)
+  try:
+    return [entry.name for entry in itertools.islice(entries, count)]
+  finally:
+    if hasattr(entries, 'close'):
+      entries.close()
+
+
 def directory_is_empty(rootfs_dir):
   """
   Return true if a directory is empty. We consider a directory with exactly
   one entry called 'lost+found' to be empty, such that the mountpoint for an
   empty ext4 filesystem is "empty".
   """
-  contents = os.listdir(rootfs_dir)
+  contents = list_first_entries(rootfs_dir, 2)
   if not contents:
     return True
   if len(contents) == 1 and contents[0] == 'lost+found':
@@ -198,6 +237,7 @@ class Configuration(object):
                external_debs=None,
                user_quirks=None,
                dpkg_configure_retry_count=1,
+               dpkg_extract_jobs=1,
                pip_wheelhouse=None,
                pip_packages=None,
                qemu_binary=None,
@@ -209,7 +249,7 @@ class Configuration(object):
     for key in extra:
       if key.startswith('_'):
         continue
-      if inspect.ismodule(extra[key]):
+      if isinstance(extra[key], types.ModuleType):
         continue
       extra_keys.append(key)
 
@@ -217,8 +257,13 @@ class Configuration(object):
       logging.warn("Unused config file options: %s",
                    ', '.join(sorted(extra_keys)))
 
-    self.architecture = get_default(architecture, get_host_architecture())
-    self.suite = get_default(suite, get_host_suite())
+    # NOTE(josh): only probe the host for defaults that are actually needed
+    if architecture is None:
+      architecture = get_host_architecture()
+    if suite is None:
+      suite = get_host_suite()
+    self.architecture = architecture
+    self.suite = suite
     self.chroot_impl = get_default(chroot_impl, 'uchroot')
     self.rootfs = get_default(rootfs, '.')
     self.apt_http_proxy = get_default(apt_http_proxy, '')
@@ -229,13 +274,15 @@ class Configuration(object):
     if apt_include_priorities == ['none']:
       self.apt_include_priorities = []
 
-    self.apt_sources = get_default(
-        apt_sources, get_bootstrap_sources(self.architecture, self.suite))
+    if apt_sources is None:
+      apt_sources = get_bootstrap_sources(self.architecture, self.suite)
+    self.apt_sources = apt_sources
     self.apt_size_report = apt_size_report
     self.apt_clean = apt_clean
     self.external_debs = get_default(external_debs, [])
     self.user_quirks = get_default(user_quirks, noop)
     self.dpkg_configure_retry_count = get_default(dpkg_configure_retry_count, 1)
+    self.dpkg_extract_jobs = get_default(dpkg_extract_jobs, 1)
     self.pip_wheelhouse = pip_wheelhouse
     self.pip_packages = get_default(pip_packages, [])
     self.qemu_binary = qemu_binary
@@ -264,18 +311,24 @@ class Configuration(object):
         logging.warn("target rootfs dir %s exists and is not empty",
                      self.rootfs)
 
+  # NOTE(josh): the field names are fixed by the signature of __init__() so
+  # they are extracted once, when the class is defined. Read them straight off
+  # the code object since inspect.getargspec() is deprecated (and gone in
+  # python 3.11).
+  _FIELD_NAMES = __init__.__code__.co_varnames[1:__init__.__code__.co_argcount]
+
   def get_field_names(self):
     """
-    Return a list of field names, extracted from kwargs to __init__().
+    Return a tuple of field names, extracted from kwargs to __init__().
     """
-    return inspect.getargspec(self.__init__).args[1:]
+    return self._FIELD_NAMES
 
   def serialize(self):
     """
     Return a dictionary describing the configuration.
     """
     return {field: getattr(self, field)
-            for field in self.get_field_names()}
+            for field in self._FIELD_NAMES}
 
   def is_enabled(self, phase):
     """
@@ -374,6 +427,13 @@ Sometimes a package will fail to configure correctly only because it hasn't
 correctly declared it's dependencies and it gets configured out of order.
 An easy work around is to just retry dpkg --configure again. Set here the
 number of times to try execugind `dpkg --configure`.
+""",
+    "dpkg_extract_jobs":
+    """\
+Number of packages to extract into the rootfs concurrently. More than one job
+can speed up extraction, but if two packages ship the same path then which of
+them wins depends on scheduling. With a single job the later package always
+wins.
 """,
     "pip_wheelhouse":
     """\
@@ -419,7 +479,6 @@ def dump_config(outfile):
   """
 
   cfg = Configuration()
-  ppr = pprint.PrettyPrinter(indent=2)
   for key in cfg.get_field_names():
     helptext = VARDOCS.get(key, None)
     if helptext:
@@ -428,14 +487,27 @@ def dump_config(outfile):
     value = getattr(cfg, key)
     if isinstance(value, dict):
       outfile.write('{} = {}\n\n'.format(key, json.dumps(value, indent=2)))
-    else:
-      outfile.write('{} = {}\n\n'.format(key, ppr.pformat(value)))
+      continue
+
+    valuestr = repr(value)
+    if isinstance(value, list) and len(key) + len(valuestr) > 77:
+      # NOTE(josh): put one item per line if the list doesn't fit on a line
+      valuestr = '[\n{}]'.format(
+          ''.join('  {!r},\n'.format(item) for item in value))
+    outfile.write('{} = {}\n\n'.format(key, valuestr))
+
+
+TRUE_STRINGS = frozenset(
+    ('y', 'yes', 't', 'true', '1', 'yup', 'yeah', 'yada'))
+FALSE_STRINGS = frozenset(
+    ('n', 'no', 'f', 'false', '0', 'nope', 'nah', 'nada'))
 
 
 def parse_bool(string):
-  if string.lower() in ('y', 'yes', 't', 'true', '1', 'yup', 'yeah', 'yada'):
+  lowered = string.lower()
+  if lowered in TRUE_STRINGS:
     return True
-  elif string.lower() in ('n', 'no', 'f', 'false', '0', 'nope', 'nah', 'nada'):
+  elif lowered in FALSE_STRINGS:
     return False
 
   logging.warn("Ambiguous truthiness of string '%s' evalutes to 'FALSE'",
@@ -443,35 +515,68 @@ def parse_bool(string):
   return False
 
 
-def add_to_argparse(parser, key, value):
+def add_bool_flag(parser, flag, helpstr, value, choices):
   """
-  Add ``key`` as a command line argument to the ``argparse.ArgumentParser``
-  ``parser``. Replace underscore with dash, infer type from ``value``,
-  lookup helpstring from VARDOCS, lookup choices in VARCHOICES.
+  Add a boolean ``flag`` which may be given with or without a value.
   """
-
-  helpstr = VARDOCS.get(key, None)
+  # pylint: disable=unused-argument
 
   # NOTE(josh): argparse store_true isn't what we want here because we want
   # to distinguish between "not specified" = "default" and "specified"
-  if isinstance(value, bool):
-    parser.add_argument('--' + key.replace('_', '-'), nargs='?', default=None,
-                        const=True, type=parse_bool, help=helpstr)
-  elif isinstance(value, (str, unicode, int, float)) or value is None:
-    if value is None:
-      valtype = str
-    else:
-      valtype = type(value)
+  parser.add_argument(flag, nargs='?', default=None, const=True,
+                      type=parse_bool, help=helpstr)
+
+
+def add_scalar_flag(parser, flag, helpstr, value, choices):
+  """
+  Add a ``flag`` taking a single value of the same type as ``value``.
+  """
+  if value is None:
+    valtype = str
+  else:
+    valtype = type(value)
+  parser.add_argument(flag, type=valtype, choices=choices, help=helpstr)
+
+
+def add_list_flag(parser, flag, helpstr, value, choices):
+  """
+  Add a ``flag`` taking any number of values.
+  """
+  # pylint: disable=unused-argument
 
-    if key in VARCHOICES:
-      parser.add_argument('--' + key.replace('_', '-'), type=valtype,
-                          choices=VARCHOICES[key], help=helpstr)
-    else:
-      parser.add_argument('--' + key.replace('_', '-'), type=valtype,
-                          help=helpstr)
   # NOTE(josh): argparse behavior is that if the flag is not specified on
   # the command line the value will be None, whereas if it's specified with
   # no arguments then the value will be an empty list. This exactly what we
   # want since we can ignore `None` values.
-  elif isinstance(value, (list, tuple)):
-    parser.add_argument('--' + key.replace('_', '-'), nargs='*', help=helpstr)
+  parser.add_argument(flag, nargs='*', help=helpstr)
+
+
+# Maps the type of a configuration default to the function that adds its
+# command line flag. Defaults of other types don't get a flag.
+FLAG_BUILDERS = {
+    bool: add_bool_flag,
+    str: add_scalar_flag,
+    int: add_scalar_flag,
+    float: add_scalar_flag,
+    type(None): add_scalar_flag,
+    list: add_list_flag,
+    tuple: add_list_flag,
+}
+
+try:
+  FLAG_BUILDERS[unicode] = add_scalar_flag
+except NameError:
+  pass
+
+
+def add_to_argparse(parser, key, value):
+  """
+  Add ``key`` as a command line argument to the ``argparse.ArgumentParser``
+  ``parser``. Replace underscore with dash, infer type from ``value``,
+  lookup helpstring from VARDOCS, lookup choices in VARCHOICES.
+  """
+
+  builder = FLAG_BUILDERS.get(type(value), None)
+  if builder is not None:
+    builder(parser, '--' + key.replace('_', '-'), VARDOCS.get(key, None),
+            value, VARCHOICES.get(key, None))
@@ -109,6 +109,12 @@ def user_quirks():
 # number of times to try execugind `dpkg --configure`.
 dpkg_configure_retry_count = 1
 
+# Number of packages to extract into the rootfs concurrently. More than one job
+# can speed up extraction, but if two packages ship the same path then which of
+# them wins depends on scheduling. With a single job the later package always
+# wins.
+dpkg_extract_jobs = 1
+
 # If installing any packages through pip, you can re-use an existing wheelhouse
 # to cache binary wheels and speed up repeated bootstrapping. Specify the
 # wheelhouse directory here
@@ -6,55 +6,52 @@ either the json apt report, or using dpkg from within the chroot
 import argparse
 import io
 import os
-import json
-import re
-import subprocess
+import operator
 import sys
 
 import buntstrap
 from buntstrap import chroot
 from buntstrap import util
 
-VERSION = '0.1.3'
+FREEZE_COLUMNS = ('name', 'version')
+SORT_KEY = operator.itemgetter(*FREEZE_COLUMNS)
 
 
 def freeze_report(report_path):
-  with open(report_path, 'r') as infile:
-    report_data = json.load(infile)
+  return sorted((util.PackageMeta(item).sub(FREEZE_COLUMNS)
+                 for item in util.iter_report(report_path)), key=SORT_KEY)
 
-  return sorted(util.PackageMeta(item).sub('name', 'version')
-                for item in report_data)
+
+# NOTE(josh): ${Package} never carries the ":arch" multiarch qualifier, and
+# the abbreviated status lets us keep only the packages that are installed,
+# just like the 'ii' rows of `dpkg --list`.
+DPKG_QUERY_FORMAT = '${db:Status-Abbrev}\t${Package}\t${Version}\n'
 
 
 def freeze_dpkg(chroot_app):
-  dpkg_proc = chroot_app.popen(['dpkg', '--list'],
-                               stdout=subprocess.PIPE)
+  output = chroot_app.check_output(
+      ['dpkg-query', '--show', '--showformat=' + DPKG_QUERY_FORMAT],
+      universal_newlines=True)
 
   out = []
-  with dpkg_proc.stdout:
-    for line in dpkg_proc.stdout:
-      if line.startswith('ii'):
-        _, name, version, _ = re.split(r'\s+', line, 3)
-        if ':' in name:
-          name, _ = name.split(':')
-        out.append({'name': name, 'version': version})
+  for line in output.splitlines():
+    parts = line.split('\t')
+    if len(parts) == 3 and parts[0].startswith('ii'):
+      out.append({'name': parts[1], 'version': parts[2]})
 
-  dpkg_proc.wait()
-  return sorted(out)
+  return sorted(out, key=SORT_KEY)
 
 
 def dump_python(outfile, sorted_items):
-  outfile.write(u'apt_packages=[\n')
-  for item in sorted_items:
-    outfile.write(u'    "{name}={version}",\n'
-                  .format(**item))
-  outfile.write(u']\n')
+  outfile.write(u'apt_packages=[\n'
+                + u''.join(u'    "%s=%s",\n' % (item['name'], item['version'])
+                           for item in sorted_items)
+                + u']\n')
 
 
 def dump_text(outfile, sorted_items):
-  for item in sorted_items:
-    outfile.write(u'{name}={version}\n'
-                  .format(**item))
+  outfile.write(u''.join(u'%s=%s\n' % (item['name'], item['version'])
+                         for item in sorted_items))
 
 
 def main():
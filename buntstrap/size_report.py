@@ -4,12 +4,25 @@ Pretty-print a sorted size report from a json package report
 
 import argparse
 import io
-import json
+import operator
 import sys
 
 from buntstrap import util
 
 
+def format_value(value, human_readable):
+  """
+  Return the string to print in the report for a single field ``value``.
+  """
+  if isinstance(value, int):
+    if human_readable:
+      return util.get_human_readable_size(value)
+    return str(value)
+  if value is None:
+    return u''
+  return value
+
+
 def print_size_report(report_data, outfile, columns=None,
                       human_readable=True, sort_column=None,
                       sort_descending=False):
@@ -23,33 +36,24 @@ def print_size_report(report_data, outfile, columns=None,
   sorted_items = sorted(
       (util.PackageMeta(item)
        for item in report_data),
-      key=lambda x: x.get(sort_column), reverse=sort_descending)
-
-  colsize = {key: 1 for key in columns}
-
-  for item in sorted_items:
-    for key in columns:
-      value = item.get(key)
-      if isinstance(value, int):
-        if human_readable:
-          value = util.get_human_readable_size(value)
-        else:
-          value = str(value)
-      vlen = len(value)
-      if vlen > colsize[key]:
-        colsize[key] = vlen
+      key=operator.itemgetter(util.PackageMeta.FIELD_INDEX[sort_column]),
+      reverse=sort_descending)
+
+  rows = [[format_value(item.get(key), human_readable) for key in columns]
+          for item in sorted_items]
+  colsize = [max([1] + [len(row[idx]) for row in rows])
+             for idx in range(len(columns))]
 
   fmt_parts = []
-  for key in columns:
+  for idx, key in enumerate(columns):
+    # NOTE(josh): right-align raw byte counts like the numbers they are
     if 'size' in key and not human_readable:
-      fmt_parts.append(u'{' + key + u':' + str(colsize[key]) + u'd}')
+      fmt_parts.append(u'{%d:>%d}' % (idx, colsize[idx]))
     else:
-      fmt_parts.append(u'{' + key + u':' + str(colsize[key]) + u's}')
+      fmt_parts.append(u'{%d:%d}' % (idx, colsize[idx]))
 
   format_str = u'  '.join(fmt_parts) + '\n'
-
-  for item in sorted_items:
-    outfile.write(format_str.format(**item.sub(columns, human_readable)))
+  outfile.write(u''.join(format_str.format(*row) for row in rows))
 
 
 def main():
@@ -73,10 +77,7 @@ def main():
   else:
     outfile = io.open(args.out_path, 'w', encoding='utf-8')
 
-  with open(args.report_path, 'r') as infile:
-    report_data = json.load(infile)
-
-  print_size_report(report_data, outfile,
+  print_size_report(util.iter_report(args.report_path), outfile,
                     columns=args.columns,
                     sort_column=args.sort_column,
                     sort_descending=args.sort_descending,
@@ -0,0 +1,90 @@
+"""
+Unit tests for buntstrap.
+"""
+
+import subprocess
+import unittest
+
+import buntstrap
+
+# NOTE(josh): (version_a, version_b, sign of the comparison) as reported by
+# `dpkg --compare-versions`
+VERSION_PAIRS = [
+    # upstream only
+    ('1.0', '1.0', 0),
+    ('1.0', '1.1', -1),
+    ('1.10', '1.9', 1),
+    ('1.001', '1.1', 0),
+    ('0.9', '0.10~', -1),
+    # epochs
+    ('1:1.0', '2.0', 1),
+    ('0:1.0', '1.0', 0),
+    ('2:0.1', '1:9.9', 1),
+    ('1:0', '0:9', 1),
+    ('1.0-1', '1:0.1-1', -1),
+    # tilde sorts before everything, even the end of the string
+    ('1.0~rc1', '1.0', -1),
+    ('1.0~~', '1.0~', -1),
+    ('1.0~', '1.0', -1),
+    ('1.0~rc1-1', '1.0-1', -1),
+    ('1.0-1~bpo1', '1.0-1', -1),
+    # missing and present revisions
+    ('1.0', '1.0-0', 0),
+    ('1.0-1', '1.0', 1),
+    ('1.0-1', '1.0-2', -1),
+    ('1.0-1ubuntu1', '1.0-1', 1),
+    ('1.2.3-4', '1.2.3-4.1', -1),
+    ('1-2-3', '1-2-10', -1),
+    # letter and number runs
+    ('1.0a', '1.0', 1),
+    ('1.0a', '1.0b', -1),
+    ('1.0.1', '1.0a', 1),
+    ('1.0', '1.0+b1', -1),
+    ('1.0+dfsg', '1.0', 1),
+    ('1.0+', '1.0.', -1),
+    ('2.30-0ubuntu2', '2.30-0ubuntu10', -1),
+    ('7.4.052-1ubuntu3', '7.4.052-1ubuntu3.1', -1),
+]
+
+
+def sign(value):
+  return (value > 0) - (value < 0)
+
+
+def dpkg_is_available():
+  try:
+    subprocess.check_call(['dpkg', '--version'], stdout=subprocess.PIPE)
+  except (OSError, subprocess.CalledProcessError):
+    return False
+  return True
+
+
+class TestVersionCompare(unittest.TestCase):
+
+  def test_dpkg_vercmp(self):
+    for version_a, version_b, expected in VERSION_PAIRS:
+      self.assertEqual(
+          expected, sign(buntstrap.dpkg_vercmp(version_a, version_b)),
+          '{} vs {}'.format(version_a, version_b))
+      self.assertEqual(
+          -expected, sign(buntstrap.dpkg_vercmp(version_b, version_a)),
+          '{} vs {}'.format(version_b, version_a))
+
+  def test_version_is_newer(self):
+    for version_a, version_b, expected in VERSION_PAIRS:
+      self.assertEqual(expected > 0,
+                       buntstrap.version_is_newer(version_a, version_b),
+                       '{} vs {}'.format(version_a, version_b))
+
+  @unittest.skipUnless(dpkg_is_available(), 'dpkg is not installed')
+  def test_table_matches_dpkg(self):
+    for version_a, version_b, expected in VERSION_PAIRS:
+      operator = {-1: 'lt', 0: 'eq', 1: 'gt'}[expected]
+      self.assertEqual(
+          0, subprocess.call(['dpkg', '--compare-versions',
+                              version_a, operator, version_b]),
+          '{} {} {}'.format(version_a, operator, version_b))
+
+
+if __name__ == '__main__':
+  unittest.main()
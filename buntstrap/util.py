@@ -1,37 +1,100 @@
+import collections
+import errno
+import functools
+import json
 import logging
-import math
-import pipes
+import os
 
+try:
+  from shlex import quote as shell_quote
+except ImportError:
+  from pipes import quote as shell_quote
 
-class ChunkReader(object):
-  """A wrapper around a file obj for use in iter(reader.read, b'')."""
+# NOTE(josh): ijson is optional. If it's available we use it to stream the
+# entries of json package reports rather than loading the whole document.
+try:
+  import ijson
+except ImportError:
+  ijson = None
 
-  def __init__(self, fileobj, chunk_size):
-    self.fileobj = fileobj
-    self.chunk_size = chunk_size
 
-  def read(self):
-    return self.fileobj.read(self.chunk_size)
+def chunk_reader(fileobj, chunk_size=4096):
+  """Return a chunk iterator for reading files."""
+  return iter(functools.partial(fileobj.read, chunk_size), b'')
 
 
-def chunk_reader(fileobj, chunk_size=4096):
-  """Return a chunk generator for reading files."""
-  reader = ChunkReader(fileobj, chunk_size)
-  for chunk in iter(reader.read, b''):
-    yield chunk
+def makedirs(path):
+  """
+  Create a directory and any missing parents, succeeding if it already exists.
+  Equivalent to ``os.makedirs(path, exist_ok=True)`` which isn't available in
+  python 2.
+  """
+  try:
+    os.makedirs(path)
+  except OSError as ex:
+    if ex.errno != errno.EEXIST or not os.path.isdir(path):
+      raise
+
+
+def memoize(func=None, maxsize=None):
+  """
+  Decorator which caches the return value of ``func`` for each distinct tuple
+  of positional arguments. Like ``functools.lru_cache`` but also available in
+  python 2. Use as ``@memoize`` for an unbounded cache, or as
+  ``@memoize(maxsize=N)`` to keep only the ``N`` most recently used results.
+  Call ``func.cache_clear()`` to reset the cache.
+  """
+  if func is None:
+    return functools.partial(memoize, maxsize=maxsize)
+
+  cache = collections.OrderedDict() if maxsize else {}
+
+  @functools.wraps(func)
+  def wrapper(*args):
+    if args in cache:
+      result = cache[args]
+      if maxsize:
+        # NOTE(josh): re-insert to mark as most recently used, python 2's
+        # OrderedDict doesn't have move_to_end()
+        del cache[args]
+        cache[args] = result
+      return result
+
+    result = func(*args)
+    cache[args] = result
+    if maxsize and len(cache) > maxsize:
+      cache.popitem(last=False)
+    return result
+
+  wrapper.cache_clear = cache.clear
+  return wrapper
+
+
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB')
 
 
 def get_human_readable_size(size_in_bytes):
   """
   Convert a number of bytes into a human readable string.
   """
-  if size_in_bytes == 0:
+  if size_in_bytes <= 0:
     return '0B'
 
-  exponent = int(math.log(size_in_bytes, 1024))
-  unit = ['B', 'KB', 'MB', 'GB', 'PB', 'EB'][exponent]
-  size_in_units = float(size_in_bytes) / (1024 ** exponent)
-  return '{:6.2f}{}'.format(size_in_units, unit)
+  # NOTE(josh): floor(log_1024(size)), computed exactly on the integer
+  exponent = min((int(size_in_bytes).bit_length() - 1) // 10,
+                 len(SIZE_UNITS) - 1)
+  size_in_units = float(size_in_bytes) / (1 << (10 * exponent))
+  return '{:6.2f}{}'.format(size_in_units, SIZE_UNITS[exponent])
+
+
+@memoize(maxsize=1024)
+def quote_arg(arg):
+  """
+  Return a shell-escaped version of the string ``arg``. The same arguments
+  (program names, paths) recur in many commands so recently used results are
+  cached.
+  """
+  return shell_quote(arg)
 
 
 def quote_args(args):
@@ -39,7 +102,7 @@ def quote_args(args):
   Opposite of shlex.split(). Will quote any argument that contains whitespace
   in it.
   """
-  return ' '.join(pipes.quote(arg) for arg in args)
+  return ' '.join(map(quote_arg, args))
 
 
 def wrap_subprocess(spfn, cmd, *args, **kwargs):
@@ -77,11 +140,37 @@ def print_and(spfn, cmd, *args, **kwargs):
   return wrap_subprocess(spfn, cmd, *args, **kwargs)
 
 
+def iter_report(report_path):
+  """
+  Return a generator over the package entries of the json report at
+  ``report_path``.
+  """
+  if ijson is None:
+    with open(report_path, 'r') as infile:
+      report_data = json.load(infile)
+    for item in report_data:
+      yield item
+    return
+
+  with open(report_path, 'rb') as infile:
+    for item in ijson.items(infile, 'item'):
+      yield item
+
+
 class PackageMeta(tuple):
   """
   Tuple of package metadata
   """
 
+  # NOTE(josh): maps field name to tuple index
+  FIELD_INDEX = {
+      u'name': 0,
+      u'packed_size': 1,
+      u'size_on_disk': 2,
+      u'description': 3,
+      u'version': 4
+  }
+
   def as_dict(self, human_readable):
     out = {
         u'name': self[0],
@@ -101,13 +190,7 @@ class PackageMeta(tuple):
       })
 
   def get(self, key):
-    return self[{
-        u'name': 0,
-        u'packed_size': 1,
-        u'size_on_disk': 2,
-        u'description': 3,
-        u'version': 4
-    }[key]]
+    return self[self.FIELD_INDEX[key]]
 
   def sub(self, columns, human_readable=False):
     out = {}